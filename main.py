@@ -6,6 +6,8 @@ import cv2          # OpenCV for image operations
 from pyzbar.pyzbar import decode # QR code decode
 import easyocr      # For Optical Character Recognition
 import re           # For regular expressions used in OCR text extraction
+import time         # for measuring OCR latency
+import yield_analytics # incremental yield rollups over the log
 
 # --- Configuration Constants ---
 LOG_FILE = 'traceability_log.csv'       
@@ -13,6 +15,41 @@ PRODUCT_DATA_FILE = 'products.csv'
 LABEL_IMAGE_FOLDER = 'label_images/'    
 BLUR_THRESHOLD = 99.99                   
 
+# OCR cascade: try a cheap downscaled read first and only escalate when needed
+OCR_CASCADE_ENABLED = True
+OCR_CASCADE_TIERS = [                   # (tier name, scale factor), tried in order
+    ('DOWNSCALED', 0.75),
+    ('NATIVE', 1.0),
+    ('UPSCALED', 2.0),
+]
+OCR_CONFIDENCE_THRESHOLD = 0.60         # min EasyOCR confidence to accept batch/serial
+OCR_BASELINE_SAMPLE_EVERY = 0          # benchmarking only: extra native read on every Nth label to measure the latency saved (0 = off)
+# Skip downscaled tiers that would make the label narrower than this (px). The label text
+# line is ~4.4% of the label width (17-18 px on the 388-460 px labels), so below 270 px it
+# drops under ~12 px tall. At that size OCR starts to confuse 0/O, 8/B, 5/S with high
+# confidence, and a confident misread is accepted without escalation.
+OCR_MIN_TIER_WIDTH = 270
+
+# Columns of the traceability log, in order
+LOG_FIELDNAMES = [
+    'Timestamp', 
+    'DeviceID', 
+    'BatchID', 
+    'OverallStatus',
+    'ComplianceStatus', 
+    'ImageQualityStatus',
+    'QR_ReadData', 
+    'QR_MatchStatus',
+    'OCR_ExtractedBatch', 
+    'OCR_BatchMatch',
+    'OCR_ExtractedSerial', 
+    'OCR_SerialMatch',
+    'OCR_BatchConfidence',
+    'OCR_SerialConfidence',
+    'OCR_ResolvedTier',
+    'ActionDetails'
+]
+
 print("Smart Labeling System Initializing... ")
 
 # Initializing EasyOCR (once)
@@ -45,11 +82,14 @@ def clean_ocr_text(text_to_clean):
     return cleaned.strip()
 
 # Extract the BatchID and SerialNumber from the label.
-def extract_specific_ocr_info(ocr_text_list):
-    extracted_info = {'batch': None, 'serial': None}
+# If the OCR confidences are given (same order as the texts) the confidence of
+# the text element each field was taken from is kept as well.
+def extract_specific_ocr_info(ocr_text_list, ocr_confidences=None):
+    extracted_info = {'batch': None, 'serial': None, 'batch_conf': None, 'serial_conf': None}
     
-    for text_element in ocr_text_list:
+    for idx, text_element in enumerate(ocr_text_list):
         text_upper = str(text_element).upper()
+        text_conf = ocr_confidences[idx] if ocr_confidences and idx < len(ocr_confidences) else None
 
         batch_match = re.search(r'(?:BATCH\s*[:\s]*)?(B)([0-9A-Z]{3,})', text_upper)
         if batch_match and not extracted_info['batch']: 
@@ -57,6 +97,7 @@ def extract_specific_ocr_info(ocr_text_list):
             alphanum_part = batch_match.group(2)
             cleaned_alphanum = alphanum_part.replace("O","0").replace("I","1").replace("L","1").replace("S","5").replace("B","8").replace("Z","2")
             extracted_info['batch'] = prefix + cleaned_alphanum
+            extracted_info['batch_conf'] = text_conf
 
         serial_match = re.search(r'(?:S[/\\]N\s*[:\s]*|SIN\s*[:\s]*)?(SN)([0-9A-Z]{3,})', text_upper)
         if serial_match and not extracted_info['serial']: 
@@ -64,6 +105,7 @@ def extract_specific_ocr_info(ocr_text_list):
             alphanum_part = serial_match.group(2)
             cleaned_alphanum = alphanum_part.replace("O","0").replace("I","1").replace("L","1").replace("S","5").replace("B","8").replace("Z","2")
             extracted_info['serial'] = prefix + cleaned_alphanum
+            extracted_info['serial_conf'] = text_conf
             
     return extracted_info
 
@@ -129,22 +171,163 @@ def read_qr_from_image(cv2_image_object):
     except Exception as e:
         return False, None, f"QR_FAIL_EXCEPTION ({e})"
 
-# Function to read text with OCR
+# Function to read text with OCR (returns the texts and their confidence scores)
 def read_text_from_label_ocr(cv2_image_object, reader): 
     if reader is None:
-        return False, [], "OCR_FAIL_NO_READER"
+        return False, [], [], "OCR_FAIL_NO_READER"
     if cv2_image_object is None: 
-        return False, [], "OCR_FAIL_NO_IMAGE"
+        return False, [], [], "OCR_FAIL_NO_IMAGE"
     
     try:
         ocr_result = reader.readtext(cv2_image_object)
         if ocr_result:
             detected_texts = [result[1] for result in ocr_result] # Extract text strings
-            return True, detected_texts, "OCR_READ_SUCCESS"
+            confidences = [float(result[2]) for result in ocr_result] # Extract confidence scores
+            return True, detected_texts, confidences, "OCR_READ_SUCCESS"
         else:
-            return False, [], "OCR_INFO_NO_TEXT_DETECTED"
+            return False, [], [], "OCR_INFO_NO_TEXT_DETECTED"
     except Exception as e:
-        return False, [], f"OCR_FAIL_EXCEPTION ({e})"
+        return False, [], [], f"OCR_FAIL_EXCEPTION ({e})"
+
+# Running statistics of the OCR cascade (which tier resolved each label, latencies)
+ocr_cascade_stats = {
+    'labels': 0,
+    'resolved_by_tier': {},   # tier name -> number of labels resolved there
+    'skipped_tier_labels': 0, # labels where a downscaled tier was skipped (below OCR_MIN_TIER_WIDTH)
+    'total_latency': 0.0,     # seconds spent in OCR over all labels
+    'baseline_samples': [],   # (native read, cascade) seconds for the same sampled label
+    'baseline_overhead': 0.0, # seconds spent on extra native reads made only for the baseline
+}
+
+# Confidence as text for prints and the log
+def format_confidence(conf):
+    return f"{conf:.2f}" if conf is not None else "N/A"
+
+# True if both batch and serial were extracted with enough confidence
+def is_confident_ocr_read(extracted_info):
+    for field in ('batch', 'serial'):
+        conf = extracted_info.get(f'{field}_conf')
+        if not extracted_info.get(field) or conf is None or conf < OCR_CONFIDENCE_THRESHOLD:
+            return False
+    return True
+
+# Score used to keep the best read when no tier is confident enough
+def score_ocr_read(extracted_info):
+    found = sum(1 for field in ('batch', 'serial') if extracted_info.get(field))
+    confs = [extracted_info.get(f'{field}_conf') or 0.0 for field in ('batch', 'serial')]
+    return found, min(confs)
+
+# Multi-resolution OCR: read a downscaled label first and escalate to bigger
+# tiers only when batch/serial are missing or below the confidence threshold.
+# The returned tier is the one that resolved the label, or UNRESOLVED.
+def read_label_ocr_cascade(cv2_image_object, reader):
+    if reader is None:
+        return False, {}, "OCR_FAIL_NO_READER", "N/A"
+    if cv2_image_object is None:
+        return False, {}, "OCR_FAIL_NO_IMAGE", "N/A"
+
+    tiers = OCR_CASCADE_TIERS if OCR_CASCADE_ENABLED else [('NATIVE', 1.0)]
+    image_width = cv2_image_object.shape[1]
+
+    best_info, best_msg, best_tier = None, "OCR_INFO_NO_TEXT_DETECTED", "N/A"
+    label_latency = 0.0
+    native_latency = None
+    resolved_tier = None
+
+    skipped_tier = False
+
+    for tier_name, scale in tiers:
+        if scale < 1.0 and image_width * scale < OCR_MIN_TIER_WIDTH:
+            skipped_tier = True
+            continue # too small to read reliably, go to the next tier
+
+        start = time.perf_counter()
+        if scale == 1.0:
+            tier_image = cv2_image_object
+        else:
+            interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_CUBIC
+            tier_image = cv2.resize(cv2_image_object, None, fx=scale, fy=scale, interpolation=interpolation)
+        ocr_success, ocr_texts_list, ocr_confidences, ocr_read_msg = read_text_from_label_ocr(tier_image, reader)
+        tier_latency = time.perf_counter() - start
+        label_latency += tier_latency
+        if scale == 1.0:
+            native_latency = tier_latency
+
+        if not ocr_success:
+            print(f"    OCR tier {tier_name} (x{scale}): {ocr_read_msg} ({tier_latency*1000:.0f} ms)")
+            if best_info is None:
+                best_msg = ocr_read_msg
+            continue
+
+        extracted_info = extract_specific_ocr_info(ocr_texts_list, ocr_confidences)
+        print(f"    OCR tier {tier_name} (x{scale}): batch={extracted_info['batch']} ({format_confidence(extracted_info['batch_conf'])}), "
+              f"serial={extracted_info['serial']} ({format_confidence(extracted_info['serial_conf'])}) ({tier_latency*1000:.0f} ms)")
+
+        if best_info is None or score_ocr_read(extracted_info) > score_ocr_read(best_info):
+            best_info, best_msg, best_tier = extracted_info, ocr_read_msg, tier_name
+
+        if is_confident_ocr_read(extracted_info):
+            resolved_tier = tier_name
+            break
+
+    # Baseline: time a native read of the same label on a regular sample, whatever
+    # tier resolved it. The first label is left out so EasyOCR warm-up is not counted.
+    label_index = ocr_cascade_stats['labels']
+    if OCR_BASELINE_SAMPLE_EVERY and label_index > 0 and label_index % OCR_BASELINE_SAMPLE_EVERY == 0:
+        if native_latency is None:
+            start = time.perf_counter()
+            read_text_from_label_ocr(cv2_image_object, reader)
+            native_latency = time.perf_counter() - start
+            ocr_cascade_stats['baseline_overhead'] += native_latency
+        ocr_cascade_stats['baseline_samples'].append((native_latency, label_latency))
+
+    # Labels that never reached the confidence threshold are counted as UNRESOLVED
+    ocr_cascade_stats['labels'] += 1
+    ocr_cascade_stats['total_latency'] += label_latency
+    if skipped_tier:
+        ocr_cascade_stats['skipped_tier_labels'] += 1
+    tier_key = resolved_tier if resolved_tier else 'UNRESOLVED'
+    ocr_cascade_stats['resolved_by_tier'][tier_key] = ocr_cascade_stats['resolved_by_tier'].get(tier_key, 0) + 1
+
+    if best_info is None:
+        return False, {}, best_msg, tier_key
+    if resolved_tier is None:
+        best_msg = f"{best_msg} (LOW_CONFIDENCE, best read at {best_tier})"
+    return True, best_info, best_msg, tier_key
+
+# Print what fraction of labels each OCR tier resolved and the latency saved
+def print_ocr_cascade_summary():
+    labels = ocr_cascade_stats['labels']
+    if labels == 0:
+        print("OCR cascade: no labels were read.")
+        return
+
+    print(f"\n--- OCR Cascade Summary ({labels} labels) ---")
+    tier_names = [tier_name for tier_name, _ in OCR_CASCADE_TIERS] + ['UNRESOLVED']
+    for tier_name in tier_names:
+        count = ocr_cascade_stats['resolved_by_tier'].get(tier_name, 0)
+        print(f"  {tier_name}: {count} ({count / labels * 100:.1f}%)")
+    skipped = ocr_cascade_stats['skipped_tier_labels']
+    print(f"  Labels too small for a downscaled tier (< {OCR_MIN_TIER_WIDTH} px): {skipped} ({skipped / labels * 100:.1f}%)")
+
+    avg_latency = ocr_cascade_stats['total_latency'] / labels
+    print(f"  Average OCR latency per label: {avg_latency*1000:.0f} ms")
+    if ocr_cascade_stats['baseline_overhead']:
+        avg_with_overhead = (ocr_cascade_stats['total_latency'] + ocr_cascade_stats['baseline_overhead']) / labels
+        print(f"  Average OCR latency per label incl. baseline reads: {avg_with_overhead*1000:.0f} ms")
+
+    # Savings compare the cascade with a native read of the same sampled labels
+    samples = ocr_cascade_stats['baseline_samples']
+    if samples:
+        avg_native = sum(native for native, _ in samples) / len(samples)
+        avg_cascade = sum(cascade for _, cascade in samples) / len(samples)
+        saved = avg_native - avg_cascade
+        print(f"  Baseline on {len(samples)} sampled labels: native read {avg_native*1000:.0f} ms, cascade {avg_cascade*1000:.0f} ms")
+        print(f"  Average latency saved per label: {saved*1000:.0f} ms ({saved / avg_native * 100 if avg_native else 0.0:.1f}%)")
+    elif not OCR_BASELINE_SAMPLE_EVERY:
+        print("  Average latency saved per label: N/A (baseline disabled, set OCR_BASELINE_SAMPLE_EVERY to measure it)")
+    else:
+        print(f"  Average latency saved per label: N/A (no label sampled yet, baseline samples every {OCR_BASELINE_SAMPLE_EVERY} labels)")
     
 # Compliance Check(RoHS Compliance)
 def verify_product_compliance(product_data):
@@ -165,29 +348,57 @@ def verify_product_compliance(product_data):
 
 # Create the log file and initialize the headers if it doesnt exist
 def initialize_log_file():
-
-    fieldnames = [
-        'Timestamp', 
-        'DeviceID', 
-        'BatchID', 
-        'OverallStatus',
-        'ComplianceStatus', 
-        'ImageQualityStatus',
-        'QR_ReadData', 
-        'QR_MatchStatus',
-        'OCR_ExtractedBatch', 
-        'OCR_BatchMatch',
-        'OCR_ExtractedSerial', 
-        'OCR_SerialMatch',
-        'ActionDetails'
-    ]
     if not os.path.exists(LOG_FILE):
-        with open(LOG_FILE, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        with open(LOG_FILE, 'w', newline='', encoding=yield_analytics.LOG_ENCODING) as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=LOG_FIELDNAMES)
             writer.writeheader()
         print(f"Log file '{LOG_FILE}' created and header written.") 
-    else:
+        return
+
+    with open(LOG_FILE, 'r', newline='', encoding=yield_analytics.LOG_ENCODING, errors='replace') as csvfile:
+        existing_header = next(csv.reader(csvfile), None)
+
+    if existing_header == LOG_FIELDNAMES:
         print(f"Log file '{LOG_FILE}' already existed. Header not rewritten.") 
+    else:
+        migrate_log_file(existing_header)
+
+# Rewrite a log with an older header to the current LOG_FIELDNAMES.
+# The original file is kept as traceability_log.<timestamp>.csv.
+def migrate_log_file(old_header):
+    base_name, extension = os.path.splitext(LOG_FILE)
+    backup_file = f"{base_name}.{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}{extension}"
+    os.replace(LOG_FILE, backup_file)
+    old_header = old_header or []
+
+    migrated_rows, skipped_rows = 0, 0
+    # Older logs may have been written with the platform encoding; undecodable bytes are replaced
+    with open(backup_file, 'r', newline='', encoding=yield_analytics.LOG_ENCODING, errors='replace') as old_csv, \
+         open(LOG_FILE, 'w', newline='', encoding=yield_analytics.LOG_ENCODING) as new_csv:
+        reader = csv.reader(old_csv)
+        next(reader, None) # old header
+        writer = csv.DictWriter(new_csv, fieldnames=LOG_FIELDNAMES, restval="N/A", extrasaction='ignore')
+        writer.writeheader()
+
+        for row in reader:
+            if not row:
+                continue
+            if len(row) == len(old_header):
+                writer.writerow(dict(zip(old_header, row)))
+            elif len(row) == len(LOG_FIELDNAMES): # row already written with the current fields
+                writer.writerow(dict(zip(LOG_FIELDNAMES, row)))
+            else:
+                skipped_rows += 1
+                continue
+            migrated_rows += 1
+
+    print(f"Log file '{LOG_FILE}' had an outdated header; migrated {migrated_rows} rows to the current header "
+          f"(original kept as '{backup_file}').")
+    dropped_columns = [column for column in old_header if column not in LOG_FIELDNAMES]
+    if dropped_columns:
+        print(f"WARNING: columns {dropped_columns} are not in the current log and were only kept in '{backup_file}'.")
+    if skipped_rows:
+        print(f"WARNING: {skipped_rows} malformed rows were not migrated, see '{backup_file}'.")
 
 # Logs an event (for one products processing result) to the CSV file using provided keyword arguments
 def log_system_event(**kwargs):
@@ -207,14 +418,16 @@ def log_system_event(**kwargs):
         'OCR_BatchMatch': kwargs.get('ocr_batch_match', "N/A"),
         'OCR_ExtractedSerial': kwargs.get('ocr_extracted_serial', "N/A"),
         'OCR_SerialMatch': kwargs.get('ocr_serial_match', "N/A"),
+        'OCR_BatchConfidence': kwargs.get('ocr_batch_confidence', "N/A"),
+        'OCR_SerialConfidence': kwargs.get('ocr_serial_confidence', "N/A"),
+        'OCR_ResolvedTier': kwargs.get('ocr_resolved_tier', "N/A"),
         'ActionDetails': kwargs.get('action_details', "")
     }
     
-    fieldnames = list(log_entry.keys())
-    
-    with open(LOG_FILE, 'a', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    with open(LOG_FILE, 'a', newline='', encoding=yield_analytics.LOG_ENCODING) as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=LOG_FIELDNAMES)
         writer.writerow(log_entry)
+    yield_analytics.record_log_entry(log_entry) # keep the yield rollups in step with the log
 
     print(f"  Logged: {log_entry['DeviceID']} - {log_entry['OverallStatus']} (Details: {log_entry['ActionDetails']})")
 
@@ -223,6 +436,9 @@ def log_system_event(**kwargs):
 # Main function
 if __name__ == "__main__":
     initialize_log_file() # call this once
+    yield_analytics.load_rollups(LOG_FILE)
+    run_start_hour = yield_analytics.hour_bucket(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    run_batch_ids = set() # batches seen in this run, for the yield report
     product_list = load_product_data(PRODUCT_DATA_FILE)
 
     if not product_list:
@@ -235,6 +451,7 @@ if __name__ == "__main__":
             device_id = product_info.get('DeviceID', 'UNKNOWN_DEVICE')
             batch_id_from_csv = product_info.get('BatchID', 'UNKNOWN_BATCH').upper().strip()
             expected_qr_serial_from_csv = product_info.get('Expected_SerialNumber_QR', '').upper().strip()
+            run_batch_ids.add(yield_analytics.clean_log_field(batch_id_from_csv))
 
             print(f"\n--- Processing product: {device_id} (Batch: {batch_id_from_csv}) ---")
 
@@ -332,15 +549,17 @@ if __name__ == "__main__":
             ocr_extracted_batch, ocr_extracted_serial = None, None
 
             if easyocr_reader and cv_image is not None: 
-                ocr_success, ocr_texts_list, ocr_read_msg = read_text_from_label_ocr(cv_image, easyocr_reader)
+                ocr_success, extracted_ocr_data, ocr_read_msg, ocr_resolved_tier = read_label_ocr_cascade(cv_image, easyocr_reader)
+                log_payload['ocr_resolved_tier'] = ocr_resolved_tier
                 print(f"    OCR Read attempt result: {ocr_read_msg}")
 
                 if ocr_success:
-                    extracted_ocr_data = extract_specific_ocr_info(ocr_texts_list)
                     ocr_extracted_batch = extracted_ocr_data.get('batch')
                     ocr_extracted_serial = extracted_ocr_data.get('serial')
                     log_payload['ocr_extracted_batch'] = ocr_extracted_batch
                     log_payload['ocr_extracted_serial'] = ocr_extracted_serial
+                    log_payload['ocr_batch_confidence'] = format_confidence(extracted_ocr_data.get('batch_conf'))
+                    log_payload['ocr_serial_confidence'] = format_confidence(extracted_ocr_data.get('serial_conf'))
 
                     # Validate OCR Batch against BatchID from CSV
                     if ocr_extracted_batch:
@@ -407,5 +626,8 @@ if __name__ == "__main__":
 
             log_system_event(overall_status=current_status, action_details=action_summary, **log_payload)
 
+        print_ocr_cascade_summary()
+        yield_analytics.save_rollups(LOG_FILE)
+        yield_analytics.print_yield_report(start_hour=run_start_hour, batch_ids=run_batch_ids)
         print("\n--- All Products Processed ---") 
         print(f"Check '{LOG_FILE}' for details.")
\ No newline at end of file
@@ -0,0 +1,285 @@
+import csv          # for streaming the log
+import hashlib      # for fingerprinting the counted part of the log
+import io           # for reading the log as text from a byte offset
+import json         # for saving the rollup tables
+import os           # for file sizes / paths
+import sys          # for command line flags
+
+# --- Configuration Constants ---
+LOG_ENCODING = 'utf-8'                  # encoding main.py writes the log with
+ROLLUP_FILE_SUFFIX = '_rollups.json'    # rollups of 'x.csv' are saved next to it as 'x_rollups.json'
+FINGERPRINT_BYTES = 256                 # bytes hashed at the start and end of the counted part of the log
+ROLLUP_COLUMNS = ['Timestamp', 'BatchID', 'OverallStatus', 'ActionDetails'] # log columns the rollups use
+
+# Failure reasons parsed from the start of ActionDetails (see STEP 5 in main.py)
+FAILURE_REASON_PREFIXES = [
+    ('All checks passed', 'NONE'),
+    ('Compliance Failure', 'COMPLIANCE'),
+    ('Image Quality Failure', 'IMAGE_QUALITY'),
+    ('Image not found', 'IMAGE_NOT_FOUND'),
+    ('Error loading label image', 'IMAGE_LOAD_ERROR'),
+    ('QR Validation Failed', 'QR'),
+    ('OCR Batch Validation Failed', 'OCR_BATCH'),
+    ('OCR Serial Validation Failed', 'OCR_SERIAL'),
+]
+OCR_REASONS = ('OCR_BATCH', 'OCR_SERIAL')
+PRE_QR_REASONS = ('COMPLIANCE', 'IMAGE_QUALITY', 'IMAGE_NOT_FOUND', 'IMAGE_LOAD_ERROR')
+
+# Rollup tables, kept up to date as rows are appended to the log
+rollups = {
+    'log_offset': 0,     # bytes of the log already counted (None if the rollups could not be built)
+    'log_fingerprint': None, # hash of the first/last bytes before log_offset
+    'skipped_rows': 0,   # malformed log rows that are not in the counts
+    'by_batch': {},      # (BatchID, OverallStatus, reason) -> count
+    'by_hour': {},       # ('YYYY-MM-DD HH:00', OverallStatus, reason) -> count
+}
+
+# Functions
+
+# Map the free text ActionDetails to a short failure reason
+def parse_failure_reason(action_details):
+    if not isinstance(action_details, str):
+        return 'OTHER'
+    for prefix, reason in FAILURE_REASON_PREFIXES:
+        if action_details.startswith(prefix):
+            return reason
+    return 'OTHER'
+
+# Hour bucket of a log timestamp ("%Y-%m-%d %H:%M:%S")
+def hour_bucket(timestamp):
+    if not isinstance(timestamp, str) or len(timestamp.strip()) < 13:
+        return 'N/A'
+    return f"{timestamp.strip()[:13]}:00"
+
+# Empty or missing log fields are counted as N/A
+def clean_log_field(value):
+    if not isinstance(value, str) or not value.strip():
+        return 'N/A'
+    return value.strip()
+
+# Rollup keys of one log row; the live and the rebuild path both go through here
+# so they always count a row the same way
+def rollup_keys(timestamp, batch_id, status, action_details):
+    status = clean_log_field(status)
+    reason = parse_failure_reason(action_details)
+    return (clean_log_field(batch_id), status, reason), (hour_bucket(timestamp), status, reason)
+
+def reset_rollups():
+    rollups['log_offset'] = 0
+    rollups['log_fingerprint'] = None
+    rollups['skipped_rows'] = 0
+    rollups['by_batch'] = {}
+    rollups['by_hour'] = {}
+
+def add_count(table, key, count=1):
+    table[key] = table.get(key, 0) + count
+
+# Update the rollups with one row, called by log_system_event after each append
+def record_log_entry(log_entry):
+    batch_key, hour_key = rollup_keys(log_entry.get('Timestamp'), log_entry.get('BatchID'),
+                                      log_entry.get('OverallStatus'), log_entry.get('ActionDetails'))
+    add_count(rollups['by_batch'], batch_key)
+    add_count(rollups['by_hour'], hour_key)
+
+# Stream the log row by row from a byte offset, so memory does not grow with the log.
+# Rows with a different number of fields than the header (e.g. a line cut off by a
+# crash mid-write) are skipped and counted in rollups['skipped_rows'].
+def read_log_from_offset(log_file, offset):
+    with open(log_file, 'rb') as f:
+        columns = next(csv.reader([f.readline().decode(LOG_ENCODING, errors='replace')]), []) # header line
+        missing_columns = [column for column in ROLLUP_COLUMNS if column not in columns]
+        if missing_columns:
+            raise ValueError(f"log '{log_file}' header is missing columns {missing_columns}")
+        column_indexes = [columns.index(column) for column in ROLLUP_COLUMNS]
+
+        if offset > f.tell():
+            f.seek(offset)
+        skipped_rows = 0
+        for row in csv.reader(io.TextIOWrapper(f, encoding=LOG_ENCODING, errors='replace', newline='')):
+            if not row:
+                continue
+            if len(row) != len(columns):
+                skipped_rows += 1
+                continue
+            batch_key, hour_key = rollup_keys(*(row[i] for i in column_indexes))
+            add_count(rollups['by_batch'], batch_key)
+            add_count(rollups['by_hour'], hour_key)
+
+    if skipped_rows:
+        rollups['skipped_rows'] += skipped_rows
+        print(f"WARNING: skipped {skipped_rows} malformed rows in '{log_file}' (field count differs from the header).")
+
+# Hash of the first and last FINGERPRINT_BYTES of log[:offset]. Rows are only ever
+# appended, so this stays the same until the log is recreated or rewritten.
+def log_fingerprint(log_file, offset):
+    if os.path.getsize(log_file) < offset:
+        return None
+    with open(log_file, 'rb') as f:
+        head = f.read(min(offset, FINGERPRINT_BYTES))
+        f.seek(max(0, offset - FINGERPRINT_BYTES))
+        tail = f.read(offset - f.tell())
+    return hashlib.sha1(head + b'|' + tail).hexdigest()
+
+# Rebuild all rollups from the full log
+def rebuild_rollups(log_file):
+    reset_rollups()
+    if not os.path.exists(log_file):
+        print(f"Log file '{log_file}' not found, rollups are empty.")
+        return
+    try:
+        log_size = os.path.getsize(log_file)
+        read_log_from_offset(log_file, 0)
+        rollups['log_offset'] = log_size
+        rollups['log_fingerprint'] = log_fingerprint(log_file, log_size)
+        print(f"Rebuilt yield rollups from '{log_file}'.")
+    except Exception as e:
+        # Only rows logged from now on are counted, and the rollups are not saved
+        print(f"ERROR: Could not rebuild yield rollups from '{log_file}': {e}")
+        reset_rollups()
+        rollups['log_offset'] = None
+
+# Rollup file that belongs to a log file
+def rollup_file_for(log_file):
+    return os.path.splitext(log_file)[0] + ROLLUP_FILE_SUFFIX
+
+# Load saved rollups and catch up with rows appended since they were saved
+def load_rollups(log_file):
+    rollup_file = rollup_file_for(log_file)
+    reset_rollups()
+    try:
+        with open(rollup_file, 'r') as f:
+            saved = json.load(f)
+        rollups['log_offset'] = saved['log_offset']
+        rollups['log_fingerprint'] = saved.get('log_fingerprint')
+        rollups['skipped_rows'] = saved.get('skipped_rows', 0)
+        rollups['by_batch'] = {tuple(row[:3]): row[3] for row in saved['by_batch']}
+        rollups['by_hour'] = {tuple(row[:3]): row[3] for row in saved['by_hour']}
+    except FileNotFoundError:
+        rebuild_rollups(log_file)
+        return
+    except Exception as e:
+        print(f"ERROR: Could not read rollup file '{rollup_file}': {e}. Rebuilding.")
+        rebuild_rollups(log_file)
+        return
+
+    if not os.path.exists(log_file):
+        reset_rollups()
+        return
+    try:
+        log_size = os.path.getsize(log_file)
+        if log_fingerprint(log_file, rollups['log_offset']) != rollups['log_fingerprint']:
+            print(f"Log file '{log_file}' was recreated or rewritten since the rollups were saved. Rebuilding.")
+            rebuild_rollups(log_file)
+        elif log_size > rollups['log_offset']:
+            read_log_from_offset(log_file, rollups['log_offset'])
+            rollups['log_offset'] = log_size
+            rollups['log_fingerprint'] = log_fingerprint(log_file, log_size)
+    except Exception as e:
+        print(f"ERROR: Could not update yield rollups from '{log_file}': {e}. Rebuilding.")
+        rebuild_rollups(log_file)
+
+# Save the rollups together with the log size and fingerprint they cover
+def save_rollups(log_file):
+    rollup_file = rollup_file_for(log_file)
+    if rollups['log_offset'] is None:
+        print(f"Yield rollups are incomplete and were not saved to '{rollup_file}'.")
+        return
+    if os.path.exists(log_file):
+        rollups['log_offset'] = os.path.getsize(log_file)
+        rollups['log_fingerprint'] = log_fingerprint(log_file, rollups['log_offset'])
+    saved = {
+        'log_offset': rollups['log_offset'],
+        'log_fingerprint': rollups['log_fingerprint'],
+        'skipped_rows': rollups['skipped_rows'],
+        'by_batch': [list(key) + [count] for key, count in rollups['by_batch'].items()],
+        'by_hour': [list(key) + [count] for key, count in rollups['by_hour'].items()],
+    }
+    try:
+        with open(rollup_file, 'w') as f:
+            json.dump(saved, f)
+    except Exception as e:
+        print(f"ERROR: Could not save yield rollups to '{rollup_file}': {e}")
+
+# Queries (only touch the rollup tables, never the log)
+
+# Yield per batch: {BatchID: {'total', 'accepted', 'rejected', 'yield'}}, optionally only for batch_ids
+def yield_by_batch(batch_ids=None):
+    report = {}
+    for (batch_id, status, _), count in rollups['by_batch'].items():
+        if batch_ids is not None and batch_id not in batch_ids:
+            continue
+        entry = report.setdefault(batch_id, {'total': 0, 'accepted': 0, 'rejected': 0, 'yield': 0.0})
+        entry['total'] += count
+        if status == 'ACCEPTED':
+            entry['accepted'] += count
+        elif status == 'REJECTED':
+            entry['rejected'] += count
+    for entry in report.values():
+        entry['yield'] = entry['accepted'] / entry['total'] if entry['total'] else 0.0
+    return report
+
+# Reject reasons per hour: {'YYYY-MM-DD HH:00': {reason: count}}, optionally within [start_hour, end_hour]
+def reject_reasons_by_hour(start_hour=None, end_hour=None):
+    report = {}
+    for (hour, status, reason), count in rollups['by_hour'].items():
+        if status != 'REJECTED':
+            continue
+        if (start_hour and hour < start_hour) or (end_hour and hour > end_hour):
+            continue
+        add_count(report.setdefault(hour, {}), reason, count)
+    return dict(sorted(report.items()))
+
+# QR failure rate over labels that reached the QR check, OCR failure rate over labels that passed it,
+# optionally within [start_hour, end_hour]
+def qr_vs_ocr_failure_rates(start_hour=None, end_hour=None):
+    reason_counts = {}
+    for (hour, _, reason), count in rollups['by_hour'].items():
+        if (start_hour and hour < start_hour) or (end_hour and hour > end_hour):
+            continue
+        add_count(reason_counts, reason, count)
+
+    reached_qr = sum(count for reason, count in reason_counts.items() if reason not in PRE_QR_REASONS)
+    qr_failures = reason_counts.get('QR', 0)
+    reached_ocr = reached_qr - qr_failures
+    ocr_failures = sum(reason_counts.get(reason, 0) for reason in OCR_REASONS)
+    return {
+        'QR': {'failures': qr_failures, 'checked': reached_qr, 'rate': qr_failures / reached_qr if reached_qr else 0.0},
+        'OCR': {'failures': ocr_failures, 'checked': reached_ocr, 'rate': ocr_failures / reached_ocr if reached_ocr else 0.0},
+    }
+
+# Print the report; main.py limits it to the batches and hours of the current run,
+# the command line prints the whole history
+def print_yield_report(start_hour=None, end_hour=None, batch_ids=None):
+    window = f" ({start_hour or 'start'} to {end_hour or 'now'})" if start_hour or end_hour else ""
+    print(f"\n--- Yield Report{window} ---")
+    if rollups['log_offset'] is None:
+        print("  WARNING: the log could not be read, counts only cover rows logged in this run.")
+    if rollups['skipped_rows']:
+        print(f"  WARNING: {rollups['skipped_rows']} malformed log rows are not included in the counts.")
+    for batch_id, entry in sorted(yield_by_batch(batch_ids).items()):
+        print(f"  {batch_id}: {entry['accepted']}/{entry['total']} accepted (yield {entry['yield']*100:.1f}%)")
+
+    print("  Reject reasons per hour:")
+    for hour, reasons in reject_reasons_by_hour(start_hour, end_hour).items():
+        reasons_text = ", ".join(f"{reason}={count}" for reason, count in sorted(reasons.items()))
+        print(f"    {hour}: {reasons_text}")
+
+    rates = qr_vs_ocr_failure_rates(start_hour, end_hour)
+    for check in ('QR', 'OCR'):
+        print(f"  {check} failure rate: {rates[check]['failures']}/{rates[check]['checked']} ({rates[check]['rate']*100:.1f}%)")
+
+
+# Print the report for a log from its saved rollups (use --rebuild to recount the whole log)
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != '--rebuild']
+    if len(args) != 1:
+        print("Usage: python yield_analytics.py <log_file.csv> [--rebuild]")
+        sys.exit(1)
+    log_file = args[0]
+
+    if '--rebuild' in sys.argv:
+        rebuild_rollups(log_file)
+    else:
+        load_rollups(log_file)
+    save_rollups(log_file)
+    print_yield_report()